@@ -3,24 +3,123 @@ Functions which interact with the CameraHub API
 """
 
 from datetime import date
+from functools import lru_cache
 import json
+import os
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-def test_credentials(l_server, l_auth):
+# Shared session so repeated API calls reuse one keep-alive connection
+# instead of paying a fresh TCP+TLS handshake per request
+_SESSION = requests.Session()
+_ADAPTER = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset(['HEAD', 'GET', 'POST'])))
+_SESSION.mount('http://', _ADAPTER)
+_SESSION.mount('https://', _ADAPTER)
+_SESSION.headers['Connection'] = 'keep-alive'
+
+# (connect, read) timeout applied to every call, so a stalled server
+# fails fast instead of hanging a batch run
+_TIMEOUT = (3.05, 30)
+
+# Outcome of credential checks per (server, auth), so a re-test within
+# the same process doesn't cost another round-trip
+_AUTH_OK = {}
+
+# Successful checks are also remembered on disk for a short time, so
+# scripted back-to-back invocations skip the startup probe entirely
+_AUTH_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".camerahub_authcache")
+_AUTH_CACHE_TTL = 300
+
+
+def _read_auth_cache():
+    """
+    Read the on-disk credential check cache, tolerating a missing or
+    mangled file
     """
-    Validate a set of credentials
+    try:
+        with open(_AUTH_CACHE_PATH, encoding="utf-8") as cachefile:
+            return json.load(cachefile)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_auth_cache(key):
+    """
+    Record a successful credential check on disk. Only the server and
+    username are stored, never the password.
+    """
+    cache = _read_auth_cache()
+    cache[key] = time.time()
+    try:
+        with open(_AUTH_CACHE_PATH, "w", encoding="utf-8") as cachefile:
+            json.dump(cache, cachefile)
+    except OSError:
+        pass
+
+
+@lru_cache(maxsize=None)
+def _endpoint(l_server, resource):
+    """
+    Build and remember the full URL for an API resource, so the
+    per-file calls don't re-concatenate the same strings
+    """
+    return f"{l_server}/{resource}/"
+
+
+def get_session():
+    """
+    Return the shared requests session, so callers can customise it
+    or inject their own transport adapters
+    """
+    return _SESSION
+
+
+def test_credentials(l_server, l_auth, force=False):
+    """
+    Validate a set of credentials. A successful check is remembered
+    both in-process and on disk for a few minutes; pass force=True to
+    probe the server regardless.
     :param server:
     :param username:
     :param password:
+    :param force:
     :return: Bool
     """
 
-    response = requests.get(
-            l_server+'/camera',
-            auth=l_auth
-        )
+    key = (l_server, l_auth)
+    cachekey = f"{l_auth[0]}@{l_server}"
+    if force:
+        _AUTH_OK.pop(key, None)
+
+    if key not in _AUTH_OK:
+        entry = None if force else _read_auth_cache().get(cachekey)
+        if entry and time.time() - entry < _AUTH_CACHE_TTL:
+            _AUTH_OK[key] = True
+        else:
+            # HEAD rather than GET - only the status code matters, so
+            # don't make the server serialise a page of results. Use
+            # the canonical trailing-slash form so the check isn't
+            # answered with an APPEND_SLASH redirect
+            response = _SESSION.head(
+                    _endpoint(l_server, 'camera'),
+                    auth=l_auth,
+                    allow_redirects=False,
+                    timeout=5
+                )
+            _AUTH_OK[key] = bool(response.status_code == 200)
+            if _AUTH_OK[key]:
+                _write_auth_cache(cachekey)
 
-    return bool(response.status_code == 200)
+    return _AUTH_OK[key]
 
 
 def create_scan(l_negative, l_filename, l_server, l_auth):
@@ -40,10 +139,10 @@ def create_scan(l_negative, l_filename, l_server, l_auth):
         'negative': l_negative,
         'filename': l_filename,
         'date': date.today()}
-    url = l_server+'/scan/'
-    response = requests.post(url, auth=l_auth, data = data)
+    url = _endpoint(l_server, 'scan')
+    response = _SESSION.post(url, auth=l_auth, data = data, timeout=_TIMEOUT)
     response.raise_for_status()
-    data=json.loads(response.text)
+    data = response.json()
     return data["uuid"]
 
 
@@ -52,29 +151,67 @@ def get_scan(l_scan, l_server, l_auth):
     Get all details about a scan record in CameraHub
     """
     payload = {'uuid': l_scan}
-    url = l_server+'/scan/'
-    response = requests.get(url, auth=l_auth, params=payload)
+    url = _endpoint(l_server, 'scan')
+    response = _SESSION.get(url, auth=l_auth, params=payload, timeout=_TIMEOUT)
     response.raise_for_status()
 
-    data=json.loads(response.text)
+    data = response.json()
     if data["count"] == 1:
         scan = data["results"][0]
 
     return scan
 
 
+@lru_cache(maxsize=4096)
 def get_negative(l_film, l_frame, l_server, l_auth):
     """
-    Find the negative slug for a negative based on its film slug and frame
+    Find the negative slug for a negative based on its film slug and frame.
+    Results are memoized for the life of the process, so several scans
+    of the same negative cost a single lookup.
     """
     # TODO: complete this function with API lookup
     payload = {'film': l_film, 'frame': l_frame}
-    url = l_server+'/negative/'
-    response = requests.get(url, auth=l_auth, params=payload)
+    url = _endpoint(l_server, 'negative')
+    response = _SESSION.get(url, auth=l_auth, params=payload, timeout=_TIMEOUT)
     response.raise_for_status()
 
-    data=json.loads(response.text)
+    data = response.json()
     if data["count"] == 1:
         negative = data["results"][0]["slug"]
 
     return negative
+
+
+def get_negatives_batch(l_pairs, l_server, l_auth):
+    """
+    Find the negative slugs for a collection of (film, frame) pairs with
+    a single API call, falling back to one get_negative call per pair on
+    servers without the batch endpoint.
+    Returns a dict mapping each resolvable (film, frame) pair to its
+    negative slug; pairs which couldn't be resolved are left out.
+    """
+    negatives = {}
+    if not l_pairs:
+        return negatives
+
+    queries = [{'film': film, 'frame': frame} for film, frame in l_pairs]
+    url = _endpoint(l_server, 'negative/batch')
+    try:
+        response = _SESSION.post(url, auth=l_auth, json={'queries': queries}, timeout=_TIMEOUT)
+        response.raise_for_status()
+        data = response.json()
+    except Exception:
+        # Server without the batch endpoint, or any other failure -
+        # degrade to resolving pairs one by one, like the per-file path
+        for film, frame in l_pairs:
+            try:
+                negatives[(film, frame)] = get_negative(film, frame, l_server, l_auth)
+            except Exception:
+                continue
+        return negatives
+
+    for query, result in zip(queries, data["results"]):
+        if result:
+            negatives[(query['film'], query['frame'])] = result["slug"]
+
+    return negatives
@@ -0,0 +1,48 @@
+"""
+Functions which handle the persistent cache of already-tagged files
+"""
+
+import os
+import sqlite3
+
+def open_cache(path, rebuild=False):
+    """
+    Open the cache of already-tagged files, creating it if necessary.
+    Each record keys a file path to the scan ID it was tagged with and
+    the file's size and mtime at the time, so unchanged files can be
+    skipped on later runs.
+    """
+    if rebuild and os.path.exists(path):
+        os.remove(path)
+
+    connection = sqlite3.connect(path)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS done"
+        "(path TEXT PRIMARY KEY, size INT, mtime REAL, scan TEXT)")
+    return connection
+
+
+def is_done(connection, file):
+    """
+    Return True if a file was already tagged on a previous run and is
+    unchanged on disk since
+    """
+    row = connection.execute(
+        "SELECT size, mtime FROM done WHERE path = ?",
+        (os.path.abspath(file),)).fetchone()
+    if row is None:
+        return False
+
+    stat = os.stat(file)
+    return row[0] == stat.st_size and row[1] == stat.st_mtime
+
+
+def mark_done(connection, file, scan):
+    """
+    Record that a file's tags are in sync with a scan ID
+    """
+    stat = os.stat(file)
+    connection.execute(
+        "INSERT OR REPLACE INTO done VALUES (?, ?, ?, ?)",
+        (os.path.abspath(file), stat.st_size, stat.st_mtime, scan))
+    connection.commit()
@@ -3,6 +3,7 @@ Functions which handle config creation and retrieval for this app
 """
 
 import configparser
+from functools import lru_cache
 import getpass
 import os
 
@@ -10,7 +11,7 @@ def create_config(path):
     """
     Create an empty config file in the user's home dir
     """
-    config = configparser.ConfigParser()
+    config = configparser.ConfigParser(interpolation=None)
 
     with open(path, "w",  encoding="utf-8") as config_file:
         config.write(config_file)
@@ -23,47 +24,51 @@ def create_profile(l_path, l_config, l_section):
 
     l_config.add_section(l_section)
 
-    try:
-        default = "https://camerahub.info/api"
-        l_server = input(f"Enter CameraHub server for profile '{l_section}' (default {default}): ") or default
-    except Exception as error:
-        print('ERROR', error)
-    else:
-        l_config.set(l_section, "server", l_server)
-
-    try:
-        l_username = input(f"Enter CameraHub username for {l_server}: ")
-    except Exception as error:
-        print('ERROR', error)
-    else:
-        l_config.set(l_section, "username", l_username)
-
-    try:
-        l_password = getpass.getpass(prompt=f"Enter CameraHub password for {l_server}: ")
-    except Exception as error:
-        print('ERROR', error)
-    else:
-        l_config.set(l_section, "password", l_password)
+    # Let exceptions from the prompts propagate - they are user-driven
+    # and should abort rather than write an incomplete profile
+    default = "https://camerahub.info/api"
+    l_server = input(f"Enter CameraHub server for profile '{l_section}' (default {default}): ") or default
+    l_username = input(f"Enter CameraHub username for {l_server}: ")
+    l_password = getpass.getpass(prompt=f"Enter CameraHub password for {l_server}: ")
+
+    l_config.set(l_section, "server", l_server)
+    l_config.set(l_section, "username", l_username)
+    l_config.set(l_section, "password", l_password)
 
     with open(l_path, "w", encoding="utf-8") as config_file:
         l_config.write(config_file)
 
 
+@lru_cache(maxsize=None)
+def _read_config(path, mtime):
+    """
+    Parse a config file, memoized on the file's path and mtime so
+    repeat reads are free but an edit on disk is picked up
+    """
+    # pylint: disable=unused-argument
+    # No interpolation - values are only ever plain strings, and this
+    # also keeps '%' characters in passwords intact
+    config = configparser.ConfigParser(interpolation=None)
+    config.read(path)
+    return config
+
+
 def get_config(path, section):
     """
-    Returns the config object, creating it if necessary
+    Returns the config object, creating it if necessary.
+    The parsed config is memoized, so fetching several settings
+    only reads the file once.
     """
     # Create the config file if necessary
     if not os.path.exists(path):
         create_config(path)
 
-    config = configparser.ConfigParser()
-    config.read(path)
+    config = _read_config(path, os.path.getmtime(path))
 
     # Ensure the requested profile exists and create if not
     if not config.has_section(section):
         create_profile(path, config, section)
-        config.read(path)
+        config = _read_config(path, os.path.getmtime(path))
 
     return config
 
@@ -2,30 +2,79 @@
 Utility functions with few external dependencies
 """
 
-from decimal import Decimal
-from uuid import UUID
 import re
 
+# Compiled once at import so the hot per-file path skips the re cache
+# lookup and the lowercased copy of every filename
+_FRAME_RE = re.compile(r'^(\d+)-(\d+).*\.jpe?g$', re.IGNORECASE)
+
+# Canonical hyphenated UUID form, with the version nibble captured so
+# is_valid_uuid can check it without constructing a UUID object
+_UUID_RE = re.compile(
+    r'\A[0-9a-f]{8}-[0-9a-f]{4}-([1-5])[0-9a-f]{3}-[89ab][0-9a-f]{3}-[0-9a-f]{12}\Z',
+    re.IGNORECASE)
+
+# Static mapping of flattened, dot-formatted CameraHub API tags to
+# their equivalent EXIF tags
+# https://exif.readthedocs.io/en/latest/api_reference.html#image-attributes
+#'Lens',
+#'FNumber'
+_APITAG2EXIF = {
+    'uuid': 'image_unique_id',
+    'negative.film.camera.cameramodel.manufacturer.name': 'make',
+    'negative.film.camera.cameramodel.lens_manufacturer': 'lens_make',
+    'negative.film.camera.cameramodel.model': 'model',
+    'negative.film.camera.serial': 'body_serial_number',
+    'negative.film.exposed_at': 'iso_speed',
+    'negative.lens.lensmodel.model': 'lens_model',
+    'negative.lens.lensmodel.manufacturer.name': 'lens_make',
+    'negative.exposure_program': 'exposure_program',
+    'negative.metering_mode': 'metering_mode',
+    'negative.caption': 'image_description',
+    'negative.date': 'datetime_original',
+    'negative.aperture': 'f_number',
+    'negative.notes': 'user_comment',
+    'negative.focal_length': 'focal_length',
+    'negative.flash': 'flash',
+    'negative.photographer.name': 'artist',
+    'negative.lens.serial': 'lens_serial_number',
+    'negative.shutter_speed': 'shutter_speed_value',
+    'negative.lens.lensmodel.max_aperture': 'max_aperture_value',
+    'negative.copyright': 'copyright',
+    'negative.focal_length_35mm': 'focal_length_in_35mm_film',
+}
+
+# API tags which become a pair of computed GPS EXIF tags rather than
+# mapping 1:1, keyed to (direction, dms tag, hemisphere ref tag)
+_GPS_TAGS = {
+    'negative.latitude': ('latitude', 'gps_latitude', 'gps_latitude_ref'),
+    'negative.longitude': ('longitude', 'gps_longitude', 'gps_longitude_ref'),
+}
+
+# The mappings above, compiled at import time into (path tuple, target)
+# pairs so api2exif can read exactly the paths it needs instead of
+# walking the whole nested API payload
+_APITAG_PATHS = [(tuple(key.split('.')), value) for key, value in _APITAG2EXIF.items()]
+_GPS_PATHS = [(tuple(key.split('.')), value) for key, value in _GPS_TAGS.items()]
+
 def deg_to_dms(degrees):
     """
     Convert from decimal degrees to degrees, minutes, seconds.
     """
-    degrees = Decimal(degrees)
-    mins, secs = divmod(abs(degrees)*3600, 60)
+    mins, secs = divmod(abs(float(degrees))*3600, 60)
     degs, mins = divmod(mins, 60)
-    degs, mins = int(degs), int(mins)
-    return degs, mins, secs
+    return int(degs), int(mins), secs
 
 
 def gps_ref(direction, angle):
     """
     Return the direction of a GPS coordinate
     """
-    angle=Decimal(angle)
+    angle = float(angle)
     if direction == 'latitude':
-        hemi = 'N' if angle>=0 else 'S'
+        hemi = 'N' if angle >= 0 else 'S'
     elif direction == 'longitude':
-        hemi = 'E' if angle>=0 else 'W'
+        hemi = 'E' if angle >= 0 else 'W'
     else:
         hemi = None
     return hemi
@@ -35,34 +84,67 @@ def diff_tags(dicta, dictb):
     """
     Compare two dictionaries of EXIF tags and return a dictionary which contains
     the diff required to apply b's data to a, without destroying data in a.
-    This uses a symmetric difference operator:
-    https://docs.python.org/3/library/stdtypes.html#frozenset.symmetric_difference
+    Only keys whose value in b is new or different are returned - tags
+    that exist solely in a are already in the file and need no write.
     """
-    seta = set(dicta.items())
-    setb = set(dictb.items())
-    return dict(seta ^ setb)
+    return {key: value for key, value in dictb.items() if dicta.get(key) != value}
 
 
 def walk(indict, pre=None):
     """
     Walk a structured, nested dictionary and it return it as a flattened list
     Each item in the stucture is returned as a list consisting of each part of
-    the hierarchy and finally the value. For example,
-    """
-    pre = pre[:] if pre else []
-    if isinstance(indict, dict):
-        for key, value in indict.items():
-            if isinstance(value, dict):
-                for d in walk(value, pre + [key]):
-                    yield d
-            elif isinstance(value, (list, tuple)):
-                for v in value:
-                    for d in walk(v, pre + [key]):
-                        yield d
-            else:
-                yield pre + [key, value]
-    else:
-        yield pre + [indict]
+    the hierarchy and finally the value. Leaves whose value is None are
+    skipped, as they carry no data. For example,
+    """
+    # Iterative traversal with an explicit stack - avoids creating a
+    # nested generator frame for every level of the structure
+    stack = [(list(pre) if pre else [], indict)]
+    while stack:
+        prefix, node = stack.pop()
+        if isinstance(node, dict):
+            # push in reverse so items pop in their original order
+            for key, value in reversed(list(node.items())):
+                stack.append((prefix + [key], value))
+        elif isinstance(node, (list, tuple)):
+            for value in reversed(node):
+                stack.append((prefix, value))
+        elif node is not None:
+            # None leaves carry no data, so don't make consumers
+            # pay to discard them
+            yield prefix + [node]
+
+
+def write_file_patch(path, old, new):
+    """
+    Overwrite a file with new contents, touching as few bytes as possible.
+    When the new contents are the same length as the old - the usual case
+    when only EXIF fields changed value - only the span of the file that
+    actually differs is rewritten in place, typically just the EXIF
+    segment rather than megabytes of unchanged image data. If the length
+    changed, fall back to rewriting the whole file.
+    """
+    blocksize = 4096
+    if len(old) != len(new):
+        with open(path, 'wb') as outfile:
+            outfile.write(new)
+        return
+
+    if old == new:
+        return
+
+    # Narrow down to the differing span a block at a time, so the
+    # comparisons run at memcmp speed
+    start = 0
+    while old[start:start+blocksize] == new[start:start+blocksize]:
+        start += blocksize
+    end = len(old)
+    while end - blocksize > start and old[end-blocksize:end] == new[end-blocksize:end]:
+        end -= blocksize
+
+    with open(path, 'r+b') as outfile:
+        outfile.seek(start)
+        outfile.write(new[start:end])
 
 
 def yes_or_no(question):
@@ -93,11 +175,8 @@ def is_valid_uuid(uuid_to_test, version=4):
     `True` if uuid_to_test is a valid UUID, otherwise `False`.
     """
 
-    try:
-        uuid_obj = UUID(uuid_to_test, version=version)
-    except ValueError:
-        return False
-    return str(uuid_obj) == uuid_to_test
+    match = _UUID_RE.match(uuid_to_test)
+    return bool(match and match.group(1) == str(version))
 
 
 def guess_frame(filename):
@@ -106,9 +185,9 @@ def guess_frame(filename):
     Assumes a format of [film]-[frame]-title.jpg
     for example 123-22-holiday.jpg
     """
-    match = re.search(r'^(\d+)-(\d+).*\.jpe?g$', filename.lower())
-    if match and match.group(0) and match.group(1):
-        returnval = (match.group(0), match.group(1))
+    match = _FRAME_RE.match(filename)
+    if match:
+        returnval = (match.group(1), match.group(2))
     else:
         returnval = None
     return returnval
@@ -132,72 +211,45 @@ def apitag2exiftag(apitag):
     https://exif.readthedocs.io/en/latest/api_reference.html#image-attributes
     """
 
-    #'Lens',
-    #'FNumber'
-
-    # Static mapping of tags
-    mapping = {
-        'uuid': 'image_unique_id',
-        'negative.film.camera.cameramodel.manufacturer.name': 'make',
-        'negative.film.camera.cameramodel.lens_manufacturer': 'lens_make',
-        'negative.film.camera.cameramodel.model': 'model',
-        'negative.film.camera.serial': 'body_serial_number',
-        'negative.film.exposed_at': 'iso_speed',
-        'negative.lens.lensmodel.model': 'lens_model',
-        'negative.lens.lensmodel.manufacturer.name': 'lens_make',
-        'negative.exposure_program': 'exposure_program',
-        'negative.metering_mode': 'metering_mode',
-        'negative.caption': 'image_description',
-        'negative.date': 'datetime_original',
-        'negative.aperture': 'f_number',
-        'negative.notes': 'user_comment',
-        'negative.focal_length': 'focal_length',
-        'negative.flash': 'flash',
-        'negative.photographer.name': 'artist',
-        'negative.lens.serial': 'lens_serial_number',
-        'negative.shutter_speed': 'shutter_speed_value',
-        'negative.lens.lensmodel.max_aperture': 'max_aperture_value',
-        'negative.copyright': 'copyright',
-        'negative.focal_length_35mm': 'focal_length_in_35mm_film',
-    }
-
-    exiftag = mapping.get(apitag)
+    exiftag = _APITAG2EXIF.get(apitag)
     return exiftag
 
 
+def extract_path(data, path):
+    """
+    Follow a tuple of keys down a nested dictionary and return the
+    value at the end, or None if any step is missing
+    """
+    for part in path:
+        if not isinstance(data, dict):
+            return None
+        data = data.get(part)
+    return data
+
+
 def api2exif(l_apidata):
     """
     Reformat CameraHub format tags into EXIF format tags.
     CameraHub tags from the API will be JSON-formatted whereas EXIF
     tags are formatted as a simple dictionary. This will also translate
     tags that have different names.
+    The set of interesting tags is fixed, so rather than flattening the
+    whole nested payload only the known paths are read directly.
     """
-    # Retrieve the flattened walk data as a list of lists
-    data = walk(l_apidata)
-
     # Make a new dictionary of EXIF data to return
     l_exifdata = {}
 
-    # Each item is one member of the nested structure
-    for row in data:
-        # The value is the last member of the list
-        value = row.pop()
+    # 1:1 mapped tags
+    for path, exifkey in _APITAG_PATHS:
+        value = extract_path(l_apidata, path)
+        if value is not None:
+            l_exifdata[exifkey] = value
 
-        # If the value is not None, build its key by concating the path
+    # "Special" tags that need computation
+    for path, (direction, dms_tag, ref_tag) in _GPS_PATHS:
+        value = extract_path(l_apidata, path)
         if value is not None:
-            key = ('.'.join(row))
-
-            # Check for "special" tags that need computation
-            if key == 'negative.latitude':
-                l_exifdata['gps_latitude'] = deg_to_dms(value)
-                l_exifdata['gps_latitude_ref'] = gps_ref('latitude', value)
-            elif key == 'negative.longitude':
-                l_exifdata['gps_longitude'] = deg_to_dms(value)
-                l_exifdata['gps_longitude_ref'] = gps_ref('longitude', value)
-            else:
-                # Otherwise do a 1:1 mapping
-                exifkey = apitag2exiftag(key)
-                if exifkey is not None:
-                    l_exifdata[exifkey] = value
+            l_exifdata[dms_tag] = deg_to_dms(value)
+            l_exifdata[ref_tag] = gps_ref(direction, value)
 
     return l_exifdata
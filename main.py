@@ -5,13 +5,156 @@ CameraHub Tagger
 import argparse
 import sys
 import os
-from fnmatch import filter as fnfilter
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
 import pprint
 from exif import Image
 from requests.models import HTTPError
-from funcs import is_valid_uuid, guess_frame, prompt_frame, api2exif, diff_tags, yes_or_no
-from config import get_setting
-from api import get_negative, get_scan, create_scan, test_credentials
+from funcs import is_valid_uuid, guess_frame, prompt_frame, api2exif, diff_tags, yes_or_no, write_file_patch
+from config import get_config
+from cache import open_cache, is_done, mark_done
+from api import get_negative, get_negatives_batch, get_scan, create_scan, test_credentials
+
+# Cap on concurrent API requests, matched to the connection pool size
+# in api.py so workers never queue for a pooled connection
+MAX_WORKERS = 16
+
+# How much of the head of a JPEG to read when checking for existing
+# EXIF data - the APP1 segment lives near the start of the file
+EXIF_HEAD_BYTES = 131072
+
+# ----------------------------------------------------------------------
+def load_exif_head(l_file):
+    """
+    Parse the EXIF data of a JPEG from a bounded read of its head,
+    instead of slurping megabytes of image data just to inspect the
+    metadata. Falls back to parsing the whole file in the rare case
+    that the head alone can't be parsed.
+    """
+    with open(l_file, 'rb') as image_file:
+        head = image_file.read(EXIF_HEAD_BYTES)
+    try:
+        return Image(head)
+    except:
+        with open(l_file, 'rb') as image_file:
+            return Image(image_file)
+
+
+def identify_file(l_file):
+    """
+    Work out which Scan a file belongs to, either from an EXIF scan ID
+    already embedded in the file, or by deducing or prompting for the
+    film/frame so one can be looked up.
+    Returns a tuple (scan, film, frame) where unknown members are None.
+    """
+    # Extract exif data from the head of the file
+    image = load_exif_head(l_file)
+
+    if image.has_exif is True and image.get("image_unique_id") and is_valid_uuid(image.image_unique_id):
+        # check for presence of custom exif tag for camerahub
+        # already has a uuid scan id
+        print(f"{l_file} already has an EXIF scan ID")
+        return (image.get("image_unique_id"), None, None)
+
+    # need to match it with a neg/print and generate a scan id
+    print(f"{l_file} does not have an EXIF scan ID")
+
+    # else prompt user to identify the scan
+    #	guess film/frame from filename
+    # match on the basename so paths from a recursive search still
+    # fit the anchored FILM-FRAME pattern
+    guess = guess_frame(os.path.basename(l_file))
+    if guess:
+        l_film, l_frame = guess
+        print(f"Deduced Film ID {l_film} and Frame {l_frame}")
+    else:
+        print(f"{l_file} does not match FILM-FRAME notation")
+        # prompt user for film/frame
+        #	either accept film/frame or just film then prompt frame
+        l_film, l_frame = prompt_frame(l_file)
+
+    return (None, l_film, l_frame)
+
+
+# pylint: disable=too-many-arguments
+def fetch_scan_data(l_file, l_scan, l_film, l_frame, l_server, l_auth, l_negatives=None):
+    """
+    Resolve a file's Scan record against the API, creating the Scan
+    first if the file doesn't have one yet. This only blocks on the
+    network, so it is safe to run from a worker thread.
+    Negatives already resolved by a batch lookup can be passed in via
+    l_negatives, keyed by (film, frame), to skip the per-file lookup.
+    Returns a tuple (scan, apidata) where either may be None on failure.
+    """
+    if l_scan is None:
+        # Lookup Negative, preferring the batch lookup results
+        negative = l_negatives.get((l_film, l_frame)) if l_negatives else None
+        if negative is None:
+            try:
+                negative = get_negative(l_film, l_frame, l_server, l_auth)
+            except HTTPError as err:
+                print(err)
+                return (None, None)
+            except:
+                print(f"Couldn't find Negative ID for {l_file}")
+                return (None, None)
+        print(f"{l_file} corresponds to Negative {negative}")
+
+        # Create Scan record associated with the Negative
+        try:
+            l_scan = create_scan(negative, os.path.basename(l_file), l_server, l_auth)
+        except:
+            print(f"Couldn't generate Scan ID for Negative {negative}")
+            return (None, None)
+        print(f"Created new Scan ID {l_scan}")
+
+    # Lookup extended Scan details in API
+    try:
+        apidata = get_scan(l_scan, l_server, l_auth)
+    except:
+        print(f"Couldn't retrieve data for Scan {l_scan}")
+        return (l_scan, None)
+    print(f"Got data for Scan {l_scan}")
+
+    return (l_scan, apidata)
+
+
+def write_tags(l_file, apidata, l_args):
+    """
+    Compare the API data for a Scan with the tags already embedded in
+    the file, and write out the difference after prompting the user.
+    Returns True if the file's tags are now in sync with the API, or
+    False if a pending diff was not written.
+    """
+    # mangle CameraHub format tags into EXIF format tags
+    exifdata = api2exif(apidata)
+
+    with open(l_file, 'rb') as image_file:
+        original = image_file.read()
+    image = Image(original)
+
+    # prepare diff of tags
+    existing = image.get_all()
+    diff = diff_tags(existing, exifdata)
+
+    # if non-zero diff, ask user to confirm tag write
+    if diff:
+        # print diff & confirm write
+        pp = pprint.PrettyPrinter()
+        pp.pprint(diff)
+
+        if l_args.dry_run or not (l_args.yes or yes_or_no("Write this metadata to the file?")):
+            return False
+
+        # Apply the diff to the image
+        for key, value in diff.items():
+            image.set(key, value)
+
+        # do the write, touching only the bytes that changed
+        write_file_patch(l_file, original, image.get_file())
+
+    return True
+
 
 # ----------------------------------------------------------------------
 if __name__ == '__main__':
@@ -25,29 +168,42 @@ if __name__ == '__main__':
     parser.add_argument('-d', '--dry-run', help="don't write any tags", action='store_true')
     parser.add_argument('-f', '--file', help="image file to be tagged", type=str)
     parser.add_argument('-p', '--profile', help="CameraHub connection profile", default='prod', type=str)
+    parser.add_argument('-j', '--jobs', help="number of processes for the tag-writing stage, only used with --yes", default=1, type=int)
+    parser.add_argument('--force-check', help="always check credentials against the server, ignoring the recent-check cache", action='store_true')
+    parser.add_argument('--no-cache', help="process every file, ignoring the cache of already-tagged files", action='store_true')
+    parser.add_argument('--rebuild-cache', help="discard the cache of already-tagged files and start afresh", action='store_true')
     args = parser.parse_args()
 
     # Determine path to config file
     home = os.path.expanduser("~")
     configpath = os.path.join(home, "camerahub.ini")
 
-    # Get our initial connection settings
+    # Open the cache of already-tagged files, so repeat runs over a
+    # large archive only touch new or changed scans
+    cache = None
+    if not args.no_cache:
+        cache = open_cache(os.path.join(home, ".camerahub_cache.db"),
+                           rebuild=args.rebuild_cache)
+
+    # Get our initial connection settings with a single config read
     # Prompt the user to set them if they don't exist
-    server = get_setting(configpath, args.profile, 'server')
-    username = get_setting(configpath, args.profile, 'username')
-    password = get_setting(configpath, args.profile, 'password')
+    profile = get_config(configpath, args.profile)[args.profile]
+    server = profile['server']
+    username = profile['username']
+    password = profile['password']
 
     # Create auth object
     auth = (username, password)
 
     # Test the credentials we have
     try:
-        test_credentials(server, auth)
+        creds_ok = test_credentials(server, auth, force=args.force_check)
     except:
+        creds_ok = False
+    if not creds_ok:
         print("Creds not OK")
-        raise PermissionError
-    else:
-        print("Creds OK")
+        sys.exit(1)
+    print("Creds OK")
 
 
     # if no args, scan current folder. consider recursive option
@@ -58,10 +214,14 @@ if __name__ == '__main__':
     if args.file:
         files.append(args.file)
     elif args.recursive:
-        # recursive search here
-        pass
+        # recursive search from the current directory
+        files = [os.path.join(root, name)
+                 for root, _, names in os.walk('.')
+                 for name in names
+                 if name.lower().endswith(('.jpg', '.jpeg'))]
     else:
-        files = fnfilter(os.listdir('.'), '*.[Jj][Pp][Gg]')
+        files = [entry.name for entry in os.scandir('.')
+                 if entry.is_file() and entry.name.lower().endswith(('.jpg', '.jpeg'))]
 
     if len(files) == 0:
         print("No files found")
@@ -69,83 +229,43 @@ if __name__ == '__main__':
 
     # foreach found photo:
     # read exif data, check for camerahub scan tag
+    # this stage may prompt the user, so it stays sequential
+    queue = []
     for file in files:
+        if cache and is_done(cache, file):
+            print(f"Skipping {file}, unchanged since it was tagged")
+            continue
         print(f"Processing image {file}")
+        scan, film, frame = identify_file(file)
+        queue.append((file, scan, film, frame))
 
-        # Extract exif data from file
-        with open(file, 'rb') as image_file:
-            image = Image(image_file)
-
-        if image.has_exif is True and image.get("image_unique_id") and is_valid_uuid(image.image_unique_id):
-            # check for presence of custom exif tag for camerahub
-            # already has a uuid scan id
-            print(f"{file} already has an EXIF scan ID")
-            scan = image.get("image_unique_id")
-        else:
-            # need to match it with a neg/print and generate a scan id
-            print(f"{file} does not have an EXIF scan ID")
-
-            # else prompt user to identify the scan
-            #	guess film/frame from filename
-            guess = guess_frame(file)
-            if guess:
-                film, frame = guess
-                print(f"Deduced Film ID {film} and Frame {frame}")
-
-            else:
-                print(f"{file} does not match FILM-FRAME notation")
-                # prompt user for film/frame
-                #	either accept film/frame or just film then prompt frame
-                film, frame = prompt_frame(file)
-
-            # Lookup Negative from API
-            try:
-                negative = get_negative(film, frame, server, auth)
-            except HTTPError as err:
-                print(err)
-                continue
-            except:
-                print(f"Couldn't find Negative ID for {file}")
-                continue
-            else:
-                print(f"{file} corresponds to Negative {negative}")
-
-            # Create Scan record associated with the Negative
-            try:
-                scan = create_scan(negative, file, server, auth)
-            except:
-                print(f"Couldn't generate Scan ID for Negative {negative}")
-                continue
-            else:
-                print(f"Created new Scan ID {scan}")
+    # resolve every outstanding (film, frame) pair in one batch call
+    # before fanning out the per-file work
+    pairs = {(film, frame) for _, scan, film, frame in queue if scan is None}
+    negatives = get_negatives_batch(pairs, server, auth)
 
-        # Lookup extended Scan details in API
-        try:
-            apidata = get_scan(scan, server, auth)
-        except:
-            print(f"Couldn't retrieve data for Scan {scan}")
-        else:
-            print(f"Got data for Scan {scan}")
-
-        # mangle CameraHub format tags into EXIF format tags
-        exifdata = api2exif(apidata)
-
-        # prepare diff of tags
-        existing = image.get_all()
-        diff = diff_tags(existing, exifdata)
+    # resolve all the Scan records concurrently - these calls only
+    # block on the network, so overlap them with a bounded worker pool
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        results = list(executor.map(
+            lambda item: fetch_scan_data(*item, server, auth, negatives), queue))
 
-        # if non-zero diff, ask user to confirm tag write
-        if len(diff) > 0:
-            # print diff & confirm write
-            pp = pprint.PrettyPrinter()
-            pp.pprint(diff)
-
-            if not args.dry_run and yes_or_no("Write this metadata to the file?"):
-
-                # Apply the diff to the image
-                for key, value in diff.items():
-                    image.set(key, value)
+    # the EXIF diff/write stage is CPU-bound on re-serialising each
+    # image, so with --yes it can fan out across processes; otherwise
+    # it stays sequential because it may prompt the user again
+    towrite = [(file, scan, apidata)
+               for (file, _, _, _), (scan, apidata) in zip(queue, results)
+               if apidata is not None]
+    if args.jobs > 1 and args.yes:
+        with Pool(args.jobs) as pool:
+            synced = pool.starmap(
+                write_tags, [(file, apidata, args) for file, _, apidata in towrite])
+    else:
+        synced = [write_tags(file, apidata, args) for file, _, apidata in towrite]
 
-                # do the write
-                with open(file, 'wb') as image_file:
-                    image_file.write(image.get_file())
+    # remember files whose tags are now in sync, so the next run can
+    # skip them without re-reading them
+    if cache:
+        for (file, scan, _), done in zip(towrite, synced):
+            if done:
+                mark_done(cache, file, scan)